@@ -16,7 +16,9 @@ Key ideas
 - A "cookbook root" is any directory that contains:
     metadata.rb  and  (recipes/ OR resources/)
 
-- For each cookbook root, we run:
+- For each cookbook root, we call `extractor.extract(<root>, <out_json>)`
+  in-process (the extractor module is loaded once per process). Pass
+  --isolate-extractor to fall back to one subprocess per cookbook:
     python extractor.py --cookbook <root> --out <out_json> --summary
 
 - Results:
@@ -27,6 +29,13 @@ Key ideas
 
 - Idempotent & resumable:
   If an output JSON already exists, the run skips it unless you pass --overwrite.
+  out/.index.sqlite maps each cookbook's git tree sha (per extractor version
+  and output format) to the output written for it, so unchanged cookbooks at a new commit/path are
+  linked/copied into place instead of being re-extracted.
+  out/checkpoint.json (+ out/done.jsonl) records fully processed repos, so an
+  interrupted run resumes without re-cloning them (same --branch, --compress
+  and --shard only; ignored with --overwrite). Both files are removed once a run completes.
+  Every manifest/errors line carries the `run_id` of the run that wrote it.
 
 Environment
 -----------
@@ -58,25 +67,61 @@ python batch_runner.py \
 from __future__ import annotations
 
 import argparse
+import atexit
 import concurrent.futures as cf
+import contextlib
+import hashlib
+import importlib.machinery
+import importlib.util
+import io
 import json
+import multiprocessing
 import os
+import queue
 import re
+import select
 import shutil
+import signal
+import sqlite3
 import subprocess
 import sys
+import tempfile
 import threading
 import time
+import uuid
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional, Tuple
+from types import ModuleType
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
 # External dep kept small + standard: install via requirements.txt
 try:
     import requests  # type: ignore
+    from requests.adapters import HTTPAdapter  # type: ignore
+    from urllib3.util.retry import Retry  # type: ignore
 except ImportError as e:
     print("Missing dependency. Please install:\n\n    pip install requests\n", file=sys.stderr)
     raise
 
+# Optional: orjson serializes JSONL lines in C (falls back to stdlib json)
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+# Optional: zstandard, only needed for --compress zstd
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+
+def _dumps(obj: Dict) -> bytes:
+    """Compact UTF-8 JSON encoding (orjson when available)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 # ------------------------------------------------------------------------------
 # Small, thread-safe logging and JSONL helpers
 # ------------------------------------------------------------------------------
@@ -91,11 +136,63 @@ def log(msg: str) -> None:
         print(f"[{ts}] {msg}", flush=True)
 
 
-def write_jsonl(path: Path, obj: Dict) -> None:
-    """Append a single compact JSON object line to a .jsonl file."""
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(obj, ensure_ascii=False) + "\n")
+class JsonlWriter:
+    """
+    Long-lived, buffered appender for one .jsonl file.
+
+    The file is opened once; each `append` serializes outside the lock and
+    then does a single buffered write under a per-file lock. Buffered lines
+    are flushed every `flush_every` records, by a background timer every
+    `flush_secs` seconds (so a quiet stretch never holds lines back), and on
+    `close()` (registered with atexit).
+    """
+
+    def __init__(self, path: Path, flush_every: int = 64, flush_secs: float = 1.0) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_secs = flush_secs
+        self._fh = path.open("ab")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._closed = threading.Event()
+        threading.Thread(target=self._flush_loop, name=f"flush:{path.name}", daemon=True).start()
+        atexit.register(self.close)
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(self.flush_secs):
+            self.flush()
+
+    def append(self, obj: Dict) -> None:
+        """Append a single compact JSON object line."""
+        line = _dumps(obj) + b"\n"
+        with self._lock:
+            self._fh.write(line)
+            self._pending += 1
+            if self._pending >= self.flush_every:
+                self._fh.flush()
+                self._pending = 0
+
+    def flush(self) -> None:
+        """Write out buffered lines, if any."""
+        with self._lock:
+            if self._pending and not self._fh.closed:
+                self._fh.flush()
+                self._pending = 0
+
+    def truncate(self) -> None:
+        """Discard everything written so far (file is emptied in place)."""
+        with self._lock:
+            self._fh.flush()
+            self._fh.truncate(0)
+            self._pending = 0
+
+    def close(self) -> None:
+        """Flush and close the file (idempotent)."""
+        self._closed.set()
+        with self._lock:
+            if not self._fh.closed:
+                self._fh.close()
 
 
 # ------------------------------------------------------------------------------
@@ -106,62 +203,267 @@ def run(cmd: List[str], cwd: Optional[str] = None, timeout: Optional[int] = None
     """
     Execute a command with optional working dir + timeout.
 
+    Output is collected with a short-interval select() loop rather than
+    Popen.communicate(timeout=...), so the deadline is checked every 100 ms
+    and a killed command never leaves us blocked draining its pipes.
+
     Returns
     -------
     (rc, stdout, stderr)
     """
-    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    out_fd, err_fd = p.stdout.fileno(), p.stderr.fileno()
+    chunks: Dict[int, List[bytes]] = {out_fd: [], err_fd: []}
+    open_fds = [out_fd, err_fd]
+    timed_out = False
     try:
-        out, err = p.communicate(timeout=timeout)
-    except subprocess.TimeoutExpired:
-        p.kill()
-        out, err = p.communicate()
+        while open_fds:
+            if deadline is not None and time.monotonic() >= deadline:
+                timed_out = True
+                break
+            ready, _, _ = select.select(open_fds, [], [], 0.1)
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if data:
+                    chunks[fd].append(data)
+                else:
+                    open_fds.remove(fd)
+        if not timed_out:
+            # Pipes closed; the process is exiting (or detached its output)
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                p.wait(timeout=remaining)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+    finally:
+        if p.poll() is None:
+            p.kill()
+        p.wait()
+        p.stdout.close()
+        p.stderr.close()
+
+    out = b"".join(chunks[out_fd]).decode("utf-8", errors="replace")
+    err = b"".join(chunks[err_fd]).decode("utf-8", errors="replace")
+    if timed_out:
         return 124, out, err or "TimeoutExpired"
     return p.returncode, out, err
 
 
-def git_shallow_clone(url: str, dest: Path, branch: Optional[str], timeout: int) -> Tuple[bool, str]:
+def cookbook_dirs_in_tree(paths: Iterable[str]) -> List[str]:
+    """
+    Given repo-relative file paths (e.g. `git ls-tree -r --name-only` output),
+    return the directories holding metadata.rb plus a recipes/ or resources/
+    sibling. The repo root is reported as "".
     """
-    Shallow clone a git repo to `dest`. If already present, try a shallow fetch.
+    meta_dirs = set()
+    code_parents = set()
+    for p in paths:
+        parts = p.split("/")
+        if parts[-1] == "metadata.rb":
+            meta_dirs.add("/".join(parts[:-1]))
+        for i, part in enumerate(parts[:-1]):
+            if part in ("recipes", "resources"):
+                code_parents.add("/".join(parts[:i]))
+    return sorted(meta_dirs & code_parents)
+
+
+def git_cookbook_dirs(repo: Path, rev: str, timeout: int) -> Tuple[bool, Union[str, Dict[str, str]]]:
+    """
+    List cookbook directories at `rev`, with their git tree shas, from the
+    tree alone (no checkout).
+
+    On a blobless mirror this needs no blob downloads, which makes it a cheap
+    probe: repos without any cookbook can be skipped before a worktree is
+    ever materialized. The same listing (`ls-tree -r -t` also reports
+    subtrees) yields each cookbook's tree sha for the idempotency index.
 
     Returns
     -------
-    (ok, commit_or_error)
+    (ok, dirs_or_error) : dirs maps each directory from `cookbook_dirs_in_tree`
+                          ("" = repo root) to its tree sha
     """
-    if dest.exists():
-        # If the path exists but isn't a repo, blow it away (defensive).
-        if not (dest / ".git").exists():
-            shutil.rmtree(dest, ignore_errors=True)
-
-    if not dest.exists():
-        cmd = ["git", "clone", "--quiet", "--depth", "1"]
-        if branch:
-            cmd += ["--branch", branch]
-        cmd += [url, str(dest)]
-        rc, out, err = run(cmd, timeout=timeout)
+    rc, out, err = run(["git", "ls-tree", "-r", "-t", "-z", rev], cwd=str(repo), timeout=timeout)
+    if rc != 0:
+        return False, f"git ls-tree failed: {err or out}"
+
+    paths: List[str] = []
+    trees: Dict[str, str] = {}
+    for entry in out.split("\0"):
+        if not entry:
+            continue
+        meta, _, path = entry.partition("\t")
+        _, kind, sha = meta.split(" ", 2)
+        if kind == "tree":
+            trees[path] = sha
+        else:
+            paths.append(path)
+
+    dirs = cookbook_dirs_in_tree(paths)
+    if "" in dirs:
+        rc, out, err = run(["git", "rev-parse", f"{rev}^{{tree}}"], cwd=str(repo), timeout=timeout)
+        if rc != 0:
+            return False, f"git rev-parse failed: {err or out}"
+        trees[""] = out.strip()
+    return True, {d: trees[d] for d in dirs}
+
+
+def _sparse_checkout_cookbooks(dest: Path, dirs: List[str], timeout: int) -> Tuple[bool, str]:
+    """
+    Materialize only cookbook-bearing subtrees (`dirs`) of a `--no-checkout`
+    worktree; on a blobless mirror only files under those directories are
+    ever downloaded (during checkout).
+    """
+    if "" not in dirs:
+        # A cookbook at the repo root needs the full tree; otherwise cone mode
+        # keeps just the cookbook dirs (plus top-level files).
+        rc, out, err = run(["git", "sparse-checkout", "set", "--cone", *dirs], cwd=str(dest), timeout=timeout)
+        if rc != 0:
+            return False, f"git sparse-checkout failed: {err or out}"
+
+    rc, out, err = run(["git", "checkout", "--quiet", "HEAD"], cwd=str(dest), timeout=timeout)
+    if rc != 0:
+        return False, f"git checkout failed: {err or out}"
+    return True, ""
+
+
+# Only branches and tags: `--mirror` would also pull every other advertised
+# ref (e.g. GitLab's refs/merge-requests/*/head) with its full history.
+_MIRROR_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+
+def git_sync_mirror(url: str, mirror: Path, timeout: int) -> Tuple[bool, str]:
+    """
+    Keep one blobless bare clone per repo URL under work_dir/mirrors.
+
+    The first run clones (`--bare --filter=blob:none`, branches + tags);
+    later runs only do an incremental `fetch --prune` of the same refs, and
+    every checkout of that repo shares the mirror's object store.
+
+    Returns
+    -------
+    (ok, error)
+    """
+    if mirror.exists() and not (mirror / "HEAD").exists():
+        # If the path exists but isn't a bare repo, blow it away (defensive).
+        shutil.rmtree(mirror, ignore_errors=True)
+
+    if not mirror.exists():
+        mirror.parent.mkdir(parents=True, exist_ok=True)
+        rc, out, err = run(["git", "clone", "--quiet", "--bare", "--filter=blob:none", url, str(mirror)], timeout=timeout)
         if rc != 0:
             return False, f"git clone failed: {err or out}"
     else:
-        # Best-effort fetch in place to keep the checkout fresh.
-        rc, out, err = run(["git", "fetch", "--depth", "1", "--all", "--prune"], cwd=str(dest), timeout=timeout)
+        # Best-effort fetch to pick up new commits; a stale mirror still works.
+        rc, out, err = run(
+            ["git", "fetch", "--quiet", "--prune", "origin", *_MIRROR_REFSPECS], cwd=str(mirror), timeout=timeout
+        )
         if rc != 0:
-            log(f"warn: fetch failed in {dest}: {err or out}")
+            log(f"warn: fetch failed in {mirror}: {err or out}")
+    return True, ""
 
-    rc, head, err = run(["git", "rev-parse", "HEAD"], cwd=str(dest), timeout=timeout)
+
+def git_resolve_commit(mirror: Path, branch: Optional[str], timeout: int) -> Tuple[bool, str]:
+    """
+    Resolve `branch` (default: the mirror's HEAD) to a commit sha.
+
+    Like `git clone --branch`, a branch of that name wins, otherwise any
+    other ref (e.g. a tag) is accepted.
+
+    Returns
+    -------
+    (ok, commit_or_error)
+    """
+    revs = [f"refs/heads/{branch}^{{commit}}", f"{branch}^{{commit}}"] if branch else ["HEAD^{commit}"]
+    for rev in revs:
+        rc, out, err = run(["git", "rev-parse", "--verify", "--quiet", rev], cwd=str(mirror), timeout=timeout)
+        if rc == 0 and out.strip():
+            return True, out.strip()
+    return False, f"git rev-parse failed: {err or out or revs[-1]}"
+
+
+def git_add_worktree(
+    mirror: Path,
+    dest: Path,
+    commit: str,
+    cookbook_dirs: List[str],
+    timeout: int,
+) -> Tuple[bool, str, Optional[Path]]:
+    """
+    Check out `commit` as an ephemeral worktree at `dest`, sparse to
+    `cookbook_dirs` (see `git_cookbook_dirs`).
+
+    Returns
+    -------
+    (ok, error, worktree_path)
+    """
+    if dest.exists():
+        # Leftover from an interrupted run
+        git_remove_worktree(mirror, dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+
+    rc, out, err = run(
+        ["git", "worktree", "add", "--quiet", "--detach", "--no-checkout", str(dest.resolve()), commit],
+        cwd=str(mirror),
+        timeout=timeout,
+    )
     if rc != 0:
-        return False, f"git rev-parse failed: {err or out}"
-    return True, head.strip()
+        return False, f"git worktree add failed: {err or out}", None
+
+    ok, err = _sparse_checkout_cookbooks(dest, cookbook_dirs, timeout)
+    if not ok:
+        git_remove_worktree(mirror, dest)
+        return False, err, None
+    return True, "", dest
+
+
+def git_remove_worktree(mirror: Path, worktree: Path) -> None:
+    """Remove an ephemeral worktree (best effort) and prune its metadata."""
+    run(["git", "worktree", "remove", "--force", str(worktree.resolve())], cwd=str(mirror))
+    if worktree.exists():
+        shutil.rmtree(worktree, ignore_errors=True)
+    run(["git", "worktree", "prune"], cwd=str(mirror))
+    # Drop the now-empty worktrees/<commit>/... parents (stops at the first
+    # non-empty one; `git worktree add` recreates them as needed)
+    with contextlib.suppress(OSError):
+        os.removedirs(worktree.parent)
 
 
 # ------------------------------------------------------------------------------
 # GitLab discovery (projects under a group)
 # ------------------------------------------------------------------------------
 
+def _gitlab_session(token: Optional[str]) -> "requests.Session":
+    """
+    Build a keep-alive session for the GitLab API.
+
+    Connections are pooled (one TLS handshake for the whole pagination), and
+    idempotent GETs are retried with exponential backoff on 429/5xx so a
+    transient hiccup doesn't abort discovery of a large group.
+    """
+    session = requests.Session()
+    retry = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["Accept-Encoding"] = "gzip"
+    if token:
+        session.headers["PRIVATE-TOKEN"] = token
+    return session
+
+
 def gitlab_iter_projects(
     base: str,
     group_path: str,
     token: Optional[str],
     include_subgroups: bool,
+    page_workers: int = 8,
 ) -> Iterable[Dict]:
     """
     Yield project dicts under a GitLab group.
@@ -171,44 +473,69 @@ def gitlab_iter_projects(
     - Uses /api/v4/groups/{group_path} to resolve the group id, then
       paginates over /api/v4/groups/{id}/projects.
     - We request 'simple' project entries (lighter payload).
+    - When page 1 carries X-Total-Pages, the remaining pages are fetched
+      concurrently (`page_workers` threads sharing the session's pool) and
+      yielded in page order.
+    - Otherwise (GitLab omits the total for very large result sets) we walk
+      sequentially, following the X-Next-Page header so the last page is not
+      followed by an extra empty round-trip.
     """
-    session = requests.Session()
-    if token:
-        session.headers["PRIVATE-TOKEN"] = token
+    session = _gitlab_session(token)
 
     # Resolve group id by path (handles self-managed GitLab too)
     r = session.get(f"{base}/api/v4/groups/{group_path}")
     r.raise_for_status()
     gid = r.json()["id"]
 
+    url = f"{base}/api/v4/groups/{gid}/projects"
+    params = {
+        "per_page": 100,
+        "include_subgroups": "true" if include_subgroups else "false",
+        "simple": "true",
+        "archived": "false",
+        "with_shared": "false",
+        "order_by": "path",
+        "sort": "asc",
+    }
+
+    def _fetch(page: int) -> "requests.Response":
+        resp = session.get(url, params={**params, "page": page})
+        resp.raise_for_status()
+        return resp
+
+    r = _fetch(1)
+    # pr contains fields like: http_url_to_repo, ssh_url_to_repo, path_with_namespace, default_branch, ...
+    yield from r.json()
+
+    total = (r.headers.get("X-Total-Pages") or "").strip()
+    if total.isdigit():
+        with cf.ThreadPoolExecutor(max_workers=page_workers) as ex:
+            for resp in ex.map(_fetch, range(2, int(total) + 1)):
+                yield from resp.json()
+        return
+
     page = 1
-    per_page = 100
     while True:
-        params = {
-            "per_page": per_page,
-            "page": page,
-            "include_subgroups": "true" if include_subgroups else "false",
-            "simple": "true",
-            "archived": "false",
-            "with_shared": "false",
-            "order_by": "path",
-            "sort": "asc",
-        }
-        r = session.get(f"{base}/api/v4/groups/{gid}/projects", params=params)
-        r.raise_for_status()
-        items = r.json()
-        if not items:
-            break
-        for pr in items:
-            # pr contains fields like: http_url_to_repo, ssh_url_to_repo, path_with_namespace, default_branch, ...
-            yield pr
-        page += 1
+        next_page = r.headers.get("X-Next-Page")
+        if next_page is None:
+            if not r.json():
+                break           # header missing: fall back to "empty page => stop"
+            page += 1
+        elif next_page.strip():
+            page = int(next_page)
+        else:
+            break               # empty header: this was the last page
+        r = _fetch(page)
+        yield from r.json()
 
 
 # ------------------------------------------------------------------------------
 # Cookbook discovery inside a repo
 # ------------------------------------------------------------------------------
 
+_SANITIZE_RE = re.compile(r"[^A-Za-z0-9._/@:-]+")
+
+
 def sanitize_path(s: str) -> str:
     """
     Turn a repo URL into a stable filesystem-friendly string for dir layout.
@@ -218,142 +545,980 @@ def sanitize_path(s: str) -> str:
     "https://gitlab.example.com/team/proj.git" ->
       "gitlab.example.com/team/proj.git"
     """
-    s = s.replace("https://", "").replace("http://", "")
-    return re.sub(r"[^A-Za-z0-9._/@:-]+", "_", s)
+    s = s.removeprefix("https://").removeprefix("http://")
+    return _SANITIZE_RE.sub("_", s)
 
 
-def find_cookbook_roots(repo_dir: Path, max_depth: int = 6) -> List[Path]:
+# Directory names never worth descending into while looking for cookbooks
+# (VCS internals, vendored deps, build output). Extend with --skip-dir.
+DEFAULT_SKIP_DIRS = frozenset({
+    ".git", "node_modules", "vendor", ".terraform", ".bundle", "target", "dist", "build",
+})
+
+
+def _walk(root: str, max_depth: int, skip_dirs: Iterable[str] = DEFAULT_SKIP_DIRS) -> List[str]:
+    """
+    Iterative os.scandir DFS returning cookbook root directories (as strings).
+
+    Each directory is listed exactly once: the same scan tells us whether it
+    holds metadata.rb plus recipes/ or resources/, and which subdirectories
+    to descend into. `skip_dirs`, hidden directories and symlinks (cycle
+    guard) are never entered, and we stop descending before metadata.rb
+    could sit deeper than `max_depth` parts.
+    """
+    skip = frozenset(skip_dirs)
+    found: List[str] = []
+    stack: List[Tuple[str, int]] = [(root, 0)]
+    while stack:
+        path, depth = stack.pop()
+        has_metadata = has_code = False
+        subdirs: List[str] = []
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    name = entry.name
+                    if name == "metadata.rb":
+                        has_metadata = entry.is_file()
+                        continue
+                    if name == "recipes" or name == "resources":
+                        has_code = True
+                    if name in skip or name.startswith("."):
+                        continue
+                    if depth + 1 < max_depth and entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+        except OSError:
+            continue
+
+        if has_metadata and has_code:
+            found.append(path)
+        stack.extend((d, depth + 1) for d in subdirs)
+    return found
+
+
+def find_cookbook_roots(
+    repo_dir: Path,
+    max_depth: int = 6,
+    skip_dirs: Iterable[str] = DEFAULT_SKIP_DIRS,
+) -> List[Path]:
     """
     Discover cookbook roots by looking for:
       metadata.rb  and  (recipes/ or resources/)
-    within a bounded search depth (to avoid crawling huge monorepos).
+    within a bounded search depth (to avoid crawling huge monorepos),
+    never entering directories named in `skip_dirs`.
 
     Returns
     -------
     List[Path] : sorted, unique paths to cookbook roots
     """
-    roots: List[Path] = []
-    for p in repo_dir.rglob("metadata.rb"):
-        # Skip overly deep matches (defensive for giant repos)
-        try:
-            rel_parts = p.relative_to(repo_dir).parts
-        except Exception:
-            continue
-        if len(rel_parts) > max_depth:
-            continue
-
-        base = p.parent
-        if (base / "recipes").exists() or (base / "resources").exists():
-            roots.append(base)
+    roots = [Path(p) for p in _walk(str(repo_dir), max_depth, skip_dirs)]
 
     # De-dup and sort by short paths first for deterministic processing
     uniq = sorted(set(roots), key=lambda x: (len(x.as_posix()), x.as_posix()))
     return uniq
 
 
+def find_cookbook_roots_cached(
+    repo_dir: Path,
+    cache_file: Path,
+    skip_dirs: Iterable[str] = DEFAULT_SKIP_DIRS,
+) -> List[Path]:
+    """
+    `find_cookbook_roots`, memoized on disk per commit.
+
+    `cache_file` should be keyed by commit sha (the tree can't change under a
+    given commit); it stores cookbook paths relative to `repo_dir` along with
+    the skip set they were discovered with, and is written via tmp + rename.
+    """
+    skip = sorted(skip_dirs)
+    if cache_file.exists():
+        try:
+            cached = json.loads(cache_file.read_text(encoding="utf-8"))
+            if cached.get("skip_dirs") == skip:
+                return [repo_dir / p for p in cached["cookbooks"]]
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass  # unreadable cache: rediscover and overwrite
+
+    cookbooks = find_cookbook_roots(repo_dir, skip_dirs=skip_dirs)
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = cache_file.with_suffix(".json.tmp")
+    tmp.write_bytes(_dumps({
+        "skip_dirs": skip,
+        "cookbooks": [p.relative_to(repo_dir).as_posix() for p in cookbooks],
+    }))
+    os.replace(tmp, cache_file)
+    return cookbooks
+
+
 # ------------------------------------------------------------------------------
 # Extraction (call extractor.py for a single cookbook)
 # ------------------------------------------------------------------------------
 
+def extractor_id(extractor: Path) -> str:
+    """
+    Identity of the extractor for the idempotency index: sha256 of its
+    source, so outputs from an older extractor.py are never reused.
+    """
+    return hashlib.sha256(extractor.read_bytes()).hexdigest()
+
+
+_EXTRACTORS: Dict[str, ModuleType] = {}
+_EXTRACTORS_LOCK = threading.Lock()
+
+
+def load_extractor(extractor: Path) -> ModuleType:
+    """
+    Import extractor.py as a module (once per process) so cookbooks can be
+    extracted without paying interpreter startup per call.
+
+    The file is loaded by path rather than by module name, so `--extractor`
+    may point anywhere (and need not end in exactly ".py").
+    """
+    key = str(extractor.resolve())
+    with _EXTRACTORS_LOCK:
+        mod = _EXTRACTORS.get(key)
+        if mod is None:
+            loader = importlib.machinery.SourceFileLoader("chef_facts_extractor", key)
+            spec = importlib.util.spec_from_loader(loader.name, loader)
+            mod = importlib.util.module_from_spec(spec)
+            loader.exec_module(mod)
+            _EXTRACTORS[key] = mod
+    return mod
+
+
+@contextlib.contextmanager
+def _deadline(seconds: Optional[int]) -> Iterator[None]:
+    """
+    Raise TimeoutError in the current code if it runs longer than `seconds`.
+
+    Relies on SIGALRM, so it is only enforced on the main thread of a POSIX
+    process; elsewhere it is a no-op (use --isolate-extractor for a hard limit).
+    """
+    if (
+        not seconds
+        or not hasattr(signal, "SIGALRM")
+        or threading.current_thread() is not threading.main_thread()
+    ):
+        yield
+        return
+
+    def _expired(signum, frame):
+        raise TimeoutError(f"extraction exceeded {seconds}s")
+
+    prev = signal.signal(signal.SIGALRM, _expired)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, prev)
+
+
+_ZSTD: Optional["zstandard.ZstdCompressor"] = None
+
+
+def _zstd_compressor() -> "zstandard.ZstdCompressor":
+    """
+    Per-process compressor, reused for every output. Not shared across
+    threads: extraction runs one cookbook at a time per worker process.
+    """
+    global _ZSTD
+    if _ZSTD is None:
+        _ZSTD = zstandard.ZstdCompressor(level=3, threads=0)
+    return _ZSTD
+
+
+def _write_json_zst(data: Dict, out_file: Path) -> None:
+    """Stream `data` as indented JSON (same format as extractor.py) into a .zst file."""
+    with out_file.open("wb") as fh, _zstd_compressor().stream_writer(fh) as zw:
+        text = io.TextIOWrapper(zw, encoding="utf-8")
+        json.dump(data, text, indent=2, ensure_ascii=False)
+        text.flush()
+        text.detach()
+
+
+def _compress_file_zst(src: Path, out_file: Path) -> None:
+    """Compress an existing JSON file into `out_file` (.zst)."""
+    with src.open("rb") as fin, out_file.open("wb") as fout:
+        _zstd_compressor().copy_stream(fin, fout)
+
+
+def _read_json_output(path: Path) -> Dict:
+    """Load a per-cookbook output (.json or .json.zst)."""
+    if path.suffix == ".zst":
+        with path.open("rb") as fh:
+            return json.load(zstandard.ZstdDecompressor().stream_reader(fh))
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def reuse_output(prev: Path, prev_name: str, out_file: Path, name: str) -> bool:
+    """
+    Put an earlier output for an identical cookbook tree at `out_file`.
+
+    When the cookbook name matches, `prev` is hardlinked (copied across
+    filesystems); otherwise the payload is rewritten with this cookbook's
+    name, since the extractor derives "cookbook" from the directory name.
+    Written via tmp + rename like `extract_cookbook`.
+
+    Returns False (leaving nothing behind) if `prev` can't be reused.
+    """
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out_file.with_suffix(out_file.suffix + ".tmp")
+    tmp.unlink(missing_ok=True)
+    try:
+        if prev_name == name:
+            try:
+                os.link(prev, tmp)
+            except OSError:
+                shutil.copyfile(prev, tmp)
+        else:
+            data = _read_json_output(prev)
+            data["cookbook"] = name
+            if out_file.suffix == ".zst":
+                _write_json_zst(data, tmp)
+            else:
+                tmp.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, out_file)
+        return True
+    except Exception:
+        # missing/unreadable earlier output: the caller re-extracts instead
+        tmp.unlink(missing_ok=True)
+        return False
+
+
 def extract_cookbook(
     extractor: Path,
     cookbook_root: Path,
     out_file: Path,
     timeout: int,
+    isolate: bool = False,
+    compress: str = "none",
 ) -> Tuple[bool, str]:
     """
     Run the single-cookbook extractor and write JSON to `out_file`.
 
+    By default the extractor runs in-process; `isolate=True` runs it as a
+    separate Python subprocess instead (slower, but crash/timeout-proof).
+    With `compress="zstd"` the output is zstd-compressed JSON (the caller
+    names it *.json.zst); in-process runs stream straight into the
+    compressor without an uncompressed copy on disk.
+
+    The extractor writes to `<out_file>.tmp`, which is renamed over
+    `out_file` only on success (os.replace is atomic on POSIX), so a crash or
+    timeout never leaves a partial JSON that later runs would mistake for a
+    finished one.
+
     Returns
     -------
-    (ok, detail)
-      ok=True  -> detail = extractor stdout (truncated by caller if needed)
-      ok=False -> detail = error text (stderr or stdout)
+    (ok, err_tail)
+      ok=True  -> err_tail = ""
+      ok=False -> err_tail = last 1 KB of the error text (exception, stderr or stdout)
     """
     out_file.parent.mkdir(parents=True, exist_ok=True)
-    cmd = [sys.executable, str(extractor), "--cookbook", str(cookbook_root), "--out", str(out_file), "--summary"]
-    rc, out, err = run(cmd, timeout=timeout)
-    if rc != 0:
-        return False, (err or out)
-    return True, out
+    tmp = out_file.with_suffix(out_file.suffix + ".tmp")
+    ok, err_tail = _run_extractor(extractor, cookbook_root, tmp, timeout, isolate, compress)
+    if ok:
+        os.replace(tmp, out_file)
+    else:
+        tmp.unlink(missing_ok=True)
+    return ok, err_tail
+
+
+def _run_extractor(
+    extractor: Path,
+    cookbook_root: Path,
+    out_file: Path,
+    timeout: int,
+    isolate: bool,
+    compress: str,
+) -> Tuple[bool, str]:
+    """Invoke the extractor (in-process or as a subprocess); see `extract_cookbook`."""
+    zstd = compress == "zstd"
+    if isolate:
+        plain = out_file.with_name(out_file.name + ".json") if zstd else out_file
+        try:
+            cmd = [sys.executable, str(extractor), "--cookbook", str(cookbook_root), "--out", str(plain), "--summary"]
+            rc, out, err = run(cmd, timeout=timeout)
+            if rc != 0:
+                return False, (err or out)[-1024:]
+            if zstd:
+                _compress_file_zst(plain, out_file)
+            return True, ""
+        finally:
+            if zstd:
+                plain.unlink(missing_ok=True)
+
+    try:
+        mod = load_extractor(extractor)
+        with _deadline(timeout):
+            if zstd:
+                data = mod.extract(str(cookbook_root))
+            else:
+                mod.extract(str(cookbook_root), str(out_file))
+        if zstd:
+            _write_json_zst(data, out_file)
+        return True, ""
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"[-1024:]
+
+
+def extract_cookbook_facts(
+    extractor: Path,
+    cookbook_root: Path,
+    timeout: int,
+    isolate: bool = False,
+) -> Tuple[Optional[Dict], str]:
+    """
+    Like `extract_cookbook`, but return the payload instead of writing a
+    per-cookbook file (used by --shard per-repo).
+
+    Returns
+    -------
+    (facts, err_tail) : facts is None on failure
+    """
+    if isolate:
+        fd, tmp_name = tempfile.mkstemp(prefix="chef-facts-", suffix=".json")
+        os.close(fd)
+        tmp = Path(tmp_name)
+        try:
+            ok, err_tail = _run_extractor(extractor, cookbook_root, tmp, timeout, isolate=True, compress="none")
+            if not ok:
+                return None, err_tail
+            return json.loads(tmp.read_text(encoding="utf-8")), ""
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    try:
+        mod = load_extractor(extractor)
+        with _deadline(timeout):
+            return mod.extract(str(cookbook_root)), ""
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"[-1024:]
+
+
+class ShardWriter:
+    """
+    Per-(repo, commit) JSONL shard holding one record per cookbook, instead
+    of one small file per cookbook.
+
+    Plain shards are flushed after every record, so cookbooks finished before
+    a crash are kept. zstd shards (.jsonl.zst) get one compressed frame per
+    writer session, appended to any earlier frames. A torn tail left by a
+    crash (partial line or unfinished frame) is cut off before appending, so
+    new records never end up behind data readers can't get past.
+    """
+
+    def __init__(self, path: Path, zstd: bool = False, truncate: bool = False) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        salvaged = b""
+        if not truncate and path.exists():
+            data = path.read_bytes()
+            _, end, salvaged = ShardWriter._intact(data, zstd)
+            if end < len(data):
+                with path.open("r+b") as fh:
+                    fh.truncate(end)
+        self._fh = path.open("wb" if truncate else "ab")
+        self._zw = _zstd_compressor().stream_writer(self._fh) if zstd else None
+        if salvaged:
+            # Complete lines decoded from the torn frame go into the new one
+            self._zw.write(salvaged)
+
+    def append(self, record: Dict) -> None:
+        line = _dumps(record) + b"\n"
+        if self._zw is not None:
+            self._zw.write(line)
+        else:
+            self._fh.write(line)
+            self._fh.flush()
+
+    def close(self) -> None:
+        if self._zw is not None:
+            self._zw.flush(zstandard.FLUSH_FRAME)
+        self._fh.close()
+
+    @staticmethod
+    def _intact(data: bytes, zstd: bool) -> Tuple[bytes, int, bytes]:
+        """
+        Split raw shard bytes at the end of the last complete line (plain) or
+        frame (zstd).
+
+        Returns
+        -------
+        (jsonl, end, salvaged)
+          jsonl    : the decoded JSONL up to that point
+          end      : its offset in `data`
+          salvaged : complete lines that could still be decoded from a torn
+                     trailing frame (zstd only)
+        """
+        if not zstd:
+            end = data.rfind(b"\n") + 1
+            return data[:end], end, b""
+
+        chunks: List[bytes] = []
+        salvaged = b""
+        end = 0
+        view = memoryview(data)
+        while end < len(data):
+            dobj = zstandard.ZstdDecompressor().decompressobj()
+            try:
+                chunk = dobj.decompress(view[end:])
+            except zstandard.ZstdError:
+                break  # corrupt frame
+            if not dobj.eof:
+                # truncated frame from an interrupted run
+                salvaged = chunk[:chunk.rfind(b"\n") + 1]
+                break
+            chunks.append(chunk)
+            end = len(data) - len(dobj.unused_data)
+        return b"".join(chunks), end, salvaged
+
+    @staticmethod
+    def records(path: Path) -> Iterator[Dict]:
+        """Records of the shard at `path` (ignores a torn tail)."""
+        if not path.exists():
+            return
+        data, _, salvaged = ShardWriter._intact(path.read_bytes(), path.suffix == ".zst")
+        data += salvaged
+
+        for line in data.splitlines():
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(rec, dict) and "cookbook" in rec:
+                yield rec
+
+    @staticmethod
+    def cookbooks_in(path: Path) -> set:
+        """Cookbook relpaths already recorded in the shard at `path`."""
+        return {rec["cookbook"] for rec in ShardWriter.records(path)}
 
 
 # ------------------------------------------------------------------------------
-# Per-repo worker: clone, discover cookbooks, extract
+# Idempotency index: (cookbook tree sha, output format) -> output produced for it
 # ------------------------------------------------------------------------------
 
-def process_repo(
-    repo_url: str,
-    out_dir: Path,
-    work_dir: Path,
-    extractor: Path,
-    clone_timeout: int,
-    extract_timeout: int,
-    overwrite: bool,
-    branch: Optional[str] = None,
-    dry_run: bool = False,
-) -> Dict:
-    """
-    Process a single repo:
-      - shallow clone (or fetch if already present)
-      - discover cookbook roots
-      - run extractor per cookbook (unless dry_run)
-      - return a compact status dict for manifest/errors
+_INDEXES: Dict[str, sqlite3.Connection] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def open_index(out_dir: Path) -> sqlite3.Connection:
+    """
+    Open (once per process) the on-disk index at out_dir/.index.sqlite.
+
+    A cookbook's git tree sha identifies its exact contents, so a renamed
+    cookbook, a commit that didn't touch it, or a fresh clone can all reuse an
+    earlier output instead of re-running the extractor. Entries are also keyed
+    by the extractor's identity (see `extractor_id`) and the output format
+    (--compress/--shard), so a reused output always comes from the same
+    extractor and has the format the current run writes. WAL mode lets the worker processes read and
+    write the index concurrently.
+    """
+    key = str((out_dir / ".index.sqlite").resolve())
+    with _INDEXES_LOCK:
+        conn = _INDEXES.get(key)
+        if conn is None:
+            conn = sqlite3.connect(key, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS extracted("
+                "tree_sha TEXT, extractor TEXT, compress TEXT, shard TEXT, "
+                "out TEXT, cookbook TEXT, name TEXT, ts INTEGER, "
+                "PRIMARY KEY (tree_sha, extractor, compress, shard))"
+            )
+            conn.commit()
+            _INDEXES[key] = conn
+    return conn
+
+
+class IndexEntry(NamedTuple):
+    """Where an earlier run put the output for a cookbook tree."""
+    out: str       # per-cookbook file, or the shard holding its record
+    cookbook: str  # cookbook relpath within its repo (the shard record key)
+    name: str      # cookbook name the extractor saw (directory basename)
+
+
+def index_lookup(
+    conn: sqlite3.Connection,
+    tree_sha: str,
+    extractor: str,
+    compress: str,
+    shard: str,
+) -> Optional[IndexEntry]:
+    """Return the recorded output for `tree_sha` from this extractor in this output format, if any."""
+    row = conn.execute(
+        "SELECT out, cookbook, name FROM extracted "
+        "WHERE tree_sha = ? AND extractor = ? AND compress = ? AND shard = ?",
+        (tree_sha, extractor, compress, shard),
+    ).fetchone()
+    return IndexEntry(*row) if row else None
+
+
+def index_record(
+    conn: sqlite3.Connection,
+    tree_sha: str,
+    extractor: str,
+    compress: str,
+    shard: str,
+    out_file: Path,
+    cookbook: str,
+    name: str,
+) -> None:
+    """Remember that `tree_sha` was extracted to `out_file` (as `cookbook`)."""
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO extracted(tree_sha, extractor, compress, shard, out, cookbook, name, ts) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (tree_sha, extractor, compress, shard, str(out_file), cookbook, name, int(time.time())),
+        )
+
+
+# ------------------------------------------------------------------------------
+# Per-repo pipeline: clone + discover (I/O stage), then extract (CPU stage)
+# ------------------------------------------------------------------------------
+
+class RepoJob(NamedTuple):
+    """Picklable bundle of per-repo arguments."""
+    repo_url: str
+    out_dir: Path
+    work_dir: Path
+    extractor: Path
+    clone_timeout: int
+    extract_timeout: int
+    overwrite: bool
+    branch: Optional[str] = None
+    dry_run: bool = False
+    isolate_extractor: bool = False
+    skip_dirs: frozenset = DEFAULT_SKIP_DIRS
+    compress: str = "none"
+    shard: str = "none"
+    extractor_id: str = ""
+
+
+class PreparedRepo(NamedTuple):
+    """A checked-out repo handed from the clone stage to the extract stage."""
+    job: RepoJob
+    commit: str
+    repo_dir: Path
+    mirror: Path
+    cookbooks: List[str]  # cookbook roots relative to repo_dir
+    tree_shas: Dict[str, str]  # cookbook dir ("" = repo root) -> git tree sha
+    t0: float
+
+
+def prepare_repo(job: RepoJob) -> Union[Dict, PreparedRepo]:
+    """
+    Clone stage for a single repo:
+      - sync the repo's mirror (clone once, then fetch)
+      - probe the commit's tree for cookbooks; if there are none, stop
+        before anything is checked out (the mirror is kept, so the next run
+        only fetches new commits)
+      - add a sparse worktree and discover cookbook roots
+
+    Returns
+    -------
+    A final status dict when there is nothing left to extract (clone_error,
+    no_cookbooks, or a dry run), otherwise a PreparedRepo whose worktree is
+    left in place for `extract_repo`.
 
     Notes
     -----
-    The output JSON path is deterministic:
-       out/<host>/<namespace>/<project>/<commit>/<cookbook_relpath>.json
+    Checkouts are ephemeral worktrees of a shared per-URL mirror
+    (work_dir/mirrors/...), removed once the repo is processed. They live at
+    work_dir/worktrees/<commit>/<host>/<namespace>/<project>, so a cookbook at
+    the repo root keeps the project's directory name (the extractor names
+    cookbooks after their directory).
     """
     t0 = time.time()
+    repo_url, work_dir = job.repo_url, job.work_dir
     host_ns_proj = sanitize_path(repo_url)
-    repo_dir = work_dir / host_ns_proj
+    mirror = work_dir / "mirrors" / (host_ns_proj if host_ns_proj.endswith(".git") else host_ns_proj + ".git")
 
-    ok, head_or_err = git_shallow_clone(repo_url, repo_dir, branch=branch, timeout=clone_timeout)
+    ok, commit_or_err = git_sync_mirror(repo_url, mirror, timeout=job.clone_timeout)
+    if ok:
+        ok, commit_or_err = git_resolve_commit(mirror, job.branch, timeout=job.clone_timeout)
     if not ok:
-        return {"repo": repo_url, "status": "clone_error", "error": head_or_err, "secs": round(time.time() - t0, 2)}
+        return {"repo": repo_url, "status": "clone_error", "error": commit_or_err, "secs": round(time.time() - t0, 2)}
+    commit = commit_or_err
 
-    commit = head_or_err
-    cookbooks = find_cookbook_roots(repo_dir)
-    if not cookbooks:
+    ok, shas_or_err = git_cookbook_dirs(mirror, commit, timeout=job.clone_timeout)
+    if not ok:
+        return {"repo": repo_url, "status": "clone_error", "error": shas_or_err, "secs": round(time.time() - t0, 2)}
+    tree_shas = shas_or_err
+    if not tree_shas:
+        # Cheap check first: no metadata.rb + recipes/resources anywhere in the
+        # tree, so skip the checkout
         return {"repo": repo_url, "status": "no_cookbooks", "commit": commit, "secs": round(time.time() - t0, 2)}
 
-    results = []
-    for root in cookbooks:
+    worktree = work_dir / "worktrees" / commit / host_ns_proj
+    ok, err, repo_dir = git_add_worktree(mirror, worktree, commit, sorted(tree_shas), timeout=job.clone_timeout)
+    if not ok:
+        return {"repo": repo_url, "status": "clone_error", "error": err, "secs": round(time.time() - t0, 2)}
+    try:
+        cache_file = work_dir / ".discovery_cache" / host_ns_proj / f"{commit}.json"
+        roots = find_cookbook_roots_cached(repo_dir, cache_file, skip_dirs=job.skip_dirs)
+    except Exception:
+        git_remove_worktree(mirror, repo_dir)
+        raise
+
+    cookbooks = []
+    for root in roots:
         # Relative path for helpful output tree
         try:
-            rel = str(root.relative_to(repo_dir))
+            cookbooks.append(str(root.relative_to(repo_dir)))
         except Exception:
-            rel = root.name
+            cookbooks.append(root.name)
+
+    if not cookbooks or job.dry_run:
+        git_remove_worktree(mirror, repo_dir)
+        if not cookbooks:
+            return {"repo": repo_url, "status": "no_cookbooks", "commit": commit, "secs": round(time.time() - t0, 2)}
+        return {
+            "repo": repo_url,
+            "status": "done",
+            "commit": commit,
+            "cookbooks": [{"cookbook": rel, "status": "dry_run"} for rel in cookbooks],
+            "secs": round(time.time() - t0, 2),
+        }
 
-        out_file = out_dir / host_ns_proj / commit / (rel + ".json")
+    return PreparedRepo(
+        job=job, commit=commit, repo_dir=repo_dir, mirror=mirror, cookbooks=cookbooks, tree_shas=tree_shas, t0=t0
+    )
 
-        if dry_run:
-            results.append({"cookbook": rel, "status": "dry_run"})
-            continue
 
-        if out_file.exists() and not overwrite:
-            results.append({"cookbook": rel, "status": "skipped", "out": str(out_file)})
-            continue
+def _existing_outputs(commit_out_dir: Path) -> set:
+    """
+    Relative paths of all files already under `commit_out_dir`, listed in one
+    directory walk (instead of one stat per cookbook, which adds up on
+    network filesystems).
+    """
+    root = str(commit_out_dir)
+    existing = set()
+    for dirpath, _, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        for name in filenames:
+            existing.add(name if rel_dir == "." else f"{rel_dir}/{name}")
+    return existing
+
 
-        ok, detail = extract_cookbook(extractor, root, out_file, timeout=extract_timeout)
-        results.append({
-            "cookbook": rel,
-            "status": "ok" if ok else "extract_error",
-            "out": str(out_file),
-            # keep a small snippet of stdout/stderr for triage
-            "detail": (detail or "").strip()[:4000],
-        })
+def extract_repo(prep: PreparedRepo) -> Dict:
+    """
+    Extract stage for a single repo: run the extractor per cookbook, skipping
+    outputs that already exist and reusing the output of cookbooks whose git
+    tree was already extracted (see `open_index`), then remove the worktree.
+
+    Notes
+    -----
+    The output JSON path is deterministic:
+       out/<host>/<namespace>/<project>/<commit>/<cookbook_relpath>.json
+    (.json.zst with --compress zstd). With --shard per-repo, all cookbooks of
+    the repo go to one shard instead, one record per line:
+       out/<host>/<namespace>/<project>/<commit>.jsonl[.zst]
+       {"cookbook": <relpath>, "tree_sha": ..., "facts": {...}}
+    A cookbook reused via the index gets a copy of its earlier record.
+    """
+    job, repo_dir, commit = prep.job, prep.repo_dir, prep.commit
+    host_ns_proj = sanitize_path(job.repo_url)
+    zstd = job.compress == "zstd"
+    sharded = job.shard == "per-repo"
+    shard: Optional[ShardWriter] = None
+    prior_shards: Dict[str, Dict[str, Dict]] = {}  # shard path -> {cookbook: record}
+    try:
+        index = open_index(job.out_dir)
+        if sharded:
+            shard_path = job.out_dir / host_ns_proj / (commit + (".jsonl.zst" if zstd else ".jsonl"))
+            done = set() if job.overwrite else ShardWriter.cookbooks_in(shard_path)
+            if job.overwrite:
+                # Rewrite the shard even if every cookbook fails below
+                shard = ShardWriter(shard_path, zstd=zstd, truncate=True)
+        else:
+            commit_out_dir = job.out_dir / host_ns_proj / commit
+            suffix = ".json.zst" if zstd else ".json"
+            existing = set() if job.overwrite else _existing_outputs(commit_out_dir)
+            done = {rel for rel in prep.cookbooks if rel + suffix in existing}
+
+        results = []
+        for rel in prep.cookbooks:
+            out_file = shard_path if sharded else commit_out_dir / (rel + suffix)
+
+            if rel in done:
+                results.append({"cookbook": rel, "status": "skipped", "out": str(out_file)})
+                continue
+
+            name = (repo_dir / rel).name
+            tree_sha = prep.tree_shas.get("" if rel == "." else rel)
+            if tree_sha and not job.overwrite:
+                prev = index_lookup(index, tree_sha, job.extractor_id, job.compress, job.shard)
+                if prev and not sharded and reuse_output(Path(prev.out), prev.name, out_file, name):
+                    results.append({"cookbook": rel, "status": "skipped_idempotent", "out": str(out_file), "tree_sha": tree_sha})
+                    continue
+                if prev and sharded:
+                    if prev.out not in prior_shards:
+                        prior_shards[prev.out] = {r["cookbook"]: r for r in ShardWriter.records(Path(prev.out))}
+                    record = prior_shards[prev.out].get(prev.cookbook)
+                    if record is not None and isinstance(record.get("facts"), dict):
+                        facts = dict(record["facts"], cookbook=name)
+                        if shard is None:
+                            shard = ShardWriter(shard_path, zstd=zstd)
+                        shard.append({"cookbook": rel, "tree_sha": tree_sha, "facts": facts})
+                        results.append({"cookbook": rel, "status": "skipped_idempotent", "out": str(shard_path), "tree_sha": tree_sha})
+                        continue
+
+            if sharded:
+                facts, err_tail = extract_cookbook_facts(
+                    job.extractor, repo_dir / rel, timeout=job.extract_timeout, isolate=job.isolate_extractor
+                )
+                ok = facts is not None
+                if ok:
+                    if shard is None:
+                        shard = ShardWriter(shard_path, zstd=zstd)
+                    shard.append({"cookbook": rel, "tree_sha": tree_sha, "facts": facts})
+            else:
+                ok, err_tail = extract_cookbook(
+                    job.extractor, repo_dir / rel, out_file,
+                    timeout=job.extract_timeout, isolate=job.isolate_extractor, compress=job.compress,
+                )
+            if ok:
+                if tree_sha:
+                    index_record(index, tree_sha, job.extractor_id, job.compress, job.shard, out_file, rel, name)
+                results.append({"cookbook": rel, "status": "ok", "out": str(out_file)})
+            else:
+                # keep the tail of the error text for triage
+                results.append({"cookbook": rel, "status": "extract_error", "out": str(out_file), "detail": err_tail})
+    finally:
+        if shard is not None:
+            shard.close()
+        git_remove_worktree(prep.mirror, repo_dir)
 
     return {
-        "repo": repo_url,
+        "repo": job.repo_url,
         "status": "done",
         "commit": commit,
         "cookbooks": results,
-        "secs": round(time.time() - t0, 2),
+        "secs": round(time.time() - prep.t0, 2),
     }
 
 
+def _extract_stage(prep: PreparedRepo) -> Dict:
+    """Process-pool entry point for `extract_repo`; never raises."""
+    try:
+        return extract_repo(prep)
+    except Exception as e:
+        # Capture unexpected exceptions so the runner keeps going
+        return {"repo": prep.job.repo_url, "status": "fatal_error", "error": repr(e)}
+
+
+def run_pipeline(jobs: List[RepoJob], clone_workers: int, extract_workers: int) -> Iterator[Dict]:
+    """
+    Run all jobs through a two-stage pipeline and yield one result dict per
+    repo, in completion order.
+
+    - Clone stage: `clone_workers` threads (network-bound) run `prepare_repo`
+      and put their output on a bounded queue (2 x extract_workers). A full
+      queue blocks further clones, so checkouts can't pile up on disk faster
+      than they are extracted.
+    - Extract stage: `extract_workers` processes (CPU-bound, ~one per core)
+      run `extract_repo`. The main thread only pulls a prepared repo off the
+      queue when a worker is free.
+
+    Workers only return dicts; all manifest/error writes and logging of
+    results happen in the caller.
+
+    A worker that dies outright (segfault/OOM in the extractor) breaks its
+    process pool: the repos it had in flight are reported as fatal_error,
+    their worktrees are removed, and a fresh pool takes over the rest.
+
+    If the consumer is interrupted (Ctrl-C raises KeyboardInterrupt in the
+    main thread), queued work in both pools is cancelled and nothing waits
+    for the tail of the queue; only in-flight commands finish (they received
+    the same SIGINT). Worktrees of prepared repos that never reached the
+    extract stage are removed.
+    """
+    handoff: "queue.Queue[Union[Dict, PreparedRepo]]" = queue.Queue(maxsize=2 * extract_workers)
+    stop = threading.Event()
+
+    def _clone_stage(job: RepoJob) -> None:
+        if stop.is_set():
+            return
+        try:
+            item = prepare_repo(job)
+        except Exception as e:
+            # Capture unexpected exceptions so the runner keeps going
+            item = {"repo": job.repo_url, "status": "fatal_error", "error": repr(e)}
+        # Block while the extract stage is saturated, but give up on shutdown
+        while not stop.is_set():
+            try:
+                handoff.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+        if isinstance(item, PreparedRepo):
+            git_remove_worktree(item.mirror, item.repo_dir)
+
+    # "spawn": forking while clone threads hold locks could deadlock workers
+    mp_ctx = multiprocessing.get_context("spawn")
+    clone_pool = cf.ThreadPoolExecutor(max_workers=clone_workers)
+    extract_pool = cf.ProcessPoolExecutor(max_workers=extract_workers, mp_context=mp_ctx)
+    interrupted = False
+    try:
+        for job in jobs:
+            clone_pool.submit(_clone_stage, job)
+
+        remaining = len(jobs)
+        inflight: Dict[cf.Future, Tuple[PreparedRepo, cf.ProcessPoolExecutor]] = {}
+        while remaining:
+            if len(inflight) < extract_workers:
+                try:
+                    item = handoff.get(timeout=0.01 if inflight else 0.1)
+                except queue.Empty:
+                    item = None
+                if isinstance(item, dict):
+                    remaining -= 1
+                    yield item
+                    continue
+                if item is not None:
+                    try:
+                        fut = extract_pool.submit(_extract_stage, item)
+                    except BrokenProcessPool:
+                        # Broken by a crash we haven't collected yet; this repo
+                        # wasn't part of it, so hand it to a fresh pool
+                        extract_pool.shutdown(wait=False)
+                        extract_pool = cf.ProcessPoolExecutor(max_workers=extract_workers, mp_context=mp_ctx)
+                        fut = extract_pool.submit(_extract_stage, item)
+                    inflight[fut] = (item, extract_pool)
+                    continue
+
+            if inflight:
+                done, _ = cf.wait(inflight, timeout=0.1, return_when=cf.FIRST_COMPLETED)
+                for fut in done:
+                    prep, pool = inflight.pop(fut)
+                    remaining -= 1
+                    try:
+                        res = fut.result()
+                    except BrokenProcessPool as e:
+                        # A worker died mid-extraction, so extract_repo's cleanup never ran
+                        git_remove_worktree(prep.mirror, prep.repo_dir)
+                        res = {"repo": prep.job.repo_url, "status": "fatal_error", "error": repr(e)}
+                        if pool is extract_pool:
+                            extract_pool.shutdown(wait=False)
+                            extract_pool = cf.ProcessPoolExecutor(max_workers=extract_workers, mp_context=mp_ctx)
+                    except Exception as e:
+                        res = {"repo": prep.job.repo_url, "status": "fatal_error", "error": repr(e)}
+                    yield res
+    except BaseException:
+        # KeyboardInterrupt, or the consumer abandoned the generator
+        interrupted = True
+        stop.set()
+        raise
+    finally:
+        clone_pool.shutdown(wait=not interrupted, cancel_futures=interrupted)
+        extract_pool.shutdown(wait=not interrupted, cancel_futures=interrupted)
+        if interrupted:
+            # Prepared repos still queued for extraction: drop their worktrees
+            while True:
+                try:
+                    item = handoff.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(item, PreparedRepo):
+                    git_remove_worktree(item.mirror, item.repo_dir)
+
+
+# ------------------------------------------------------------------------------
+# Resumable checkpoint (repos already fully processed)
+# ------------------------------------------------------------------------------
+
+class Checkpoint:
+    """
+    Set of completed repo URLs persisted under out_dir, so that an
+    interrupted run can be resumed.
+
+    Completions are appended to done.jsonl as they happen (cheap, buffered);
+    every `compact_every` completions and on an interrupted close, the full
+    set is rewritten to checkpoint.json via tmp + rename and done.jsonl is
+    emptied. A run that completes deletes both files, so the next scheduled
+    run processes every repo again (picking up new commits).
+
+    Entries are scoped by `branch`, `compress` and `shard`: a checkpoint left
+    by a run with another --branch or output format is ignored (its repos may
+    have no output in this run's format).
+    """
+
+    def __init__(
+        self,
+        out_dir: Path,
+        run_id: str,
+        branch: Optional[str] = None,
+        compress: str = "none",
+        shard: str = "none",
+        compact_every: int = 100,
+    ) -> None:
+        self.path = out_dir / "checkpoint.json"
+        self.log_path = out_dir / "done.jsonl"
+        self.run_id = run_id
+        self.scope = {"branch": branch or "", "compress": compress, "shard": shard}
+        self.compact_every = compact_every
+        self.done: set = set()
+
+        if self.path.exists():
+            try:
+                state = json.loads(self.path.read_text(encoding="utf-8"))
+                if self._in_scope(state):
+                    self.done.update(state.get("done", []))
+                else:
+                    log(f"warn: ignoring checkpoint {self.path} from a run with other --branch/--compress/--shard")
+            except (OSError, ValueError, AttributeError) as e:
+                log(f"warn: ignoring unreadable checkpoint {self.path}: {e}")
+        if self.log_path.exists():
+            for line in self.log_path.read_text(encoding="utf-8").splitlines():
+                try:
+                    rec = json.loads(line)
+                    if self._in_scope(rec):
+                        self.done.add(rec["repo"])
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    continue  # torn last line from an interrupted run
+
+        self._log = JsonlWriter(self.log_path)
+        self._since_compact = 0
+
+    def _in_scope(self, entry: Dict) -> bool:
+        """Whether a stored entry was made with this run's branch and output format."""
+        return (
+            entry.get("branch", "") == self.scope["branch"]
+            and entry.get("compress", "none") == self.scope["compress"]
+            and entry.get("shard", "none") == self.scope["shard"]
+        )
+
+    def mark(self, repo_url: str) -> None:
+        """Record `repo_url` as completed."""
+        self.done.add(repo_url)
+        self._log.append({"repo": repo_url, **self.scope, "run_id": self.run_id})
+        self._since_compact += 1
+        if self._since_compact >= self.compact_every:
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite checkpoint.json atomically, then empty done.jsonl."""
+        tmp = self.path.with_suffix(".json.tmp")
+        tmp.write_bytes(_dumps({"run_id": self.run_id, **self.scope, "done": sorted(self.done)}))
+        os.replace(tmp, self.path)
+        self._log.truncate()
+        self._since_compact = 0
+
+    def close(self, completed: bool = False) -> None:
+        """
+        Persist the checkpoint for a later resume, or, once the run has
+        `completed`, remove it (nothing is left to resume).
+        """
+        if completed:
+            self._log.close()
+            self.path.unlink(missing_ok=True)
+            self.log_path.unlink(missing_ok=True)
+            return
+        self.compact()
+        self._log.close()
+
+
 # ------------------------------------------------------------------------------
 # Main CLI
 # ------------------------------------------------------------------------------
@@ -386,25 +1551,54 @@ def main() -> None:
     ap.add_argument("--work-dir", required=True, help="Directory to clone repositories (can be reused)")
     ap.add_argument("--extractor", required=True, help="Path to extractor.py")
 
-    ap.add_argument("--concurrency", type=int, default=8, help="Parallelism for clones/extractions")
+    ap.add_argument("--concurrency", type=int, default=8,
+                    help="Parallel clones (network-bound stage); default for --clone-concurrency")
+    ap.add_argument("--clone-concurrency", type=int, default=None,
+                    help="Parallel clone/discovery workers (default: --concurrency)")
+    ap.add_argument("--extract-concurrency", type=int, default=None,
+                    help="Parallel extraction processes (default: CPU count)")
     ap.add_argument("--clone-timeout", type=int, default=900, help="Seconds allowed for git clone (default 900)")
     ap.add_argument("--extract-timeout", type=int, default=600, help="Seconds allowed per cookbook extraction (default 600)")
     ap.add_argument("--overwrite", action="store_true", help="Overwrite existing outputs instead of skipping")
     ap.add_argument("--branch", default=None, help="Optional git branch to clone (default: repo default)")
     ap.add_argument("--limit", type=int, default=0, help="Process only the first N repos (0 = no limit)")
     ap.add_argument("--dry-run", action="store_true", help="Do not run extractor; just list discovered cookbooks")
+    ap.add_argument("--skip-dir", action="append", default=[], metavar="NAME",
+                    help="Extra directory name to skip during cookbook discovery (repeatable)")
+    ap.add_argument("--compress", choices=["none", "zstd"], default="none",
+                    help="Compress per-cookbook outputs (zstd writes <cookbook>.json.zst; needs `pip install zstandard`)")
+    ap.add_argument("--shard", choices=["none", "per-repo"], default="none",
+                    help="per-repo: write one <commit>.jsonl shard per repo (one record per cookbook) instead of one file per cookbook")
+    ap.add_argument("--isolate-extractor", action="store_true",
+                    help="Run the extractor as one subprocess per cookbook instead of in-process (slower; hard timeouts)")
 
     args = ap.parse_args()
+    if args.compress == "zstd" and zstandard is None:
+        ap.error("--compress zstd requires the 'zstandard' package (pip install zstandard)")
 
     out_dir = Path(args.out_dir)
     work_dir = Path(args.work_dir)
     extractor = Path(args.extractor)
+    skip_dirs = DEFAULT_SKIP_DIRS | frozenset(args.skip_dir)
 
     out_dir.mkdir(parents=True, exist_ok=True)
     work_dir.mkdir(parents=True, exist_ok=True)
 
+    # Import the extractor once up front so a broken install fails fast
+    # instead of surfacing as an extract_error on every cookbook.
+    if not args.dry_run and not args.isolate_extractor:
+        load_extractor(extractor)
+    ext_id = "" if args.dry_run else extractor_id(extractor)
+
     manifest_path = out_dir / "manifest.jsonl"
     errors_path = out_dir / "errors.jsonl"
+    manifest = JsonlWriter(manifest_path)
+    errors = JsonlWriter(errors_path)
+
+    run_id = uuid.uuid4().hex
+    checkpoint = None if args.dry_run else Checkpoint(
+        out_dir, run_id, branch=args.branch, compress=args.compress, shard=args.shard
+    )
 
     # --------------------------------------------------------------------------
     # Build the list of repos to process
@@ -427,57 +1621,84 @@ def main() -> None:
             if url:
                 repos.append(url)
 
+    # Resume: drop repos an interrupted previous run already completed
+    if checkpoint and checkpoint.done and not args.overwrite:
+        before = len(repos)
+        repos = [r for r in repos if r not in checkpoint.done]
+        log(f"Resuming: skipping {before - len(repos)} repos already completed (checkpoint {checkpoint.path})")
+
     if args.limit and len(repos) > args.limit:
         repos = repos[:args.limit]
 
-    log(f"Total repos to process: {len(repos)} (concurrency={args.concurrency})")
+    clone_workers = args.clone_concurrency or args.concurrency
+    extract_workers = args.extract_concurrency or os.cpu_count() or 1
+    log(f"Total repos to process: {len(repos)} "
+        f"(clone_concurrency={clone_workers}, extract_concurrency={extract_workers}, run_id={run_id})")
     started = time.time()
 
     # --------------------------------------------------------------------------
-    # Thread pool to process repos in parallel
+    # Two-stage pipeline: clone threads feed extract processes (see run_pipeline)
     # --------------------------------------------------------------------------
-    def _work(url: str) -> Dict:
-        try:
-            return process_repo(
-                repo_url=url,
-                out_dir=out_dir,
-                work_dir=work_dir,
-                extractor=extractor,
-                clone_timeout=args.clone_timeout,
-                extract_timeout=args.extract_timeout,
-                overwrite=args.overwrite,
-                branch=args.branch,
-                dry_run=args.dry_run,
-            )
-        except Exception as e:
-            # Capture unexpected exceptions so the runner keeps going
-            return {"repo": url, "status": "fatal_error", "error": repr(e)}
-
-    with cf.ThreadPoolExecutor(max_workers=args.concurrency) as ex:
-        futs = [ex.submit(_work, u) for u in repos]
-        for fut in cf.as_completed(futs):
-            res = fut.result()
+    jobs = [
+        RepoJob(
+            repo_url=url,
+            out_dir=out_dir,
+            work_dir=work_dir,
+            extractor=extractor,
+            clone_timeout=args.clone_timeout,
+            extract_timeout=args.extract_timeout,
+            overwrite=args.overwrite,
+            branch=args.branch,
+            dry_run=args.dry_run,
+            isolate_extractor=args.isolate_extractor,
+            skip_dirs=skip_dirs,
+            compress=args.compress,
+            shard=args.shard,
+            extractor_id=ext_id,
+        )
+        for url in repos
+    ]
+    interrupted = False
+    try:
+        for res in run_pipeline(jobs, clone_workers, extract_workers):
+            res["run_id"] = run_id
 
             # Clone-level or unexpected failure
             if res.get("status") in ("fatal_error", "clone_error"):
-                write_jsonl(errors_path, res)
+                errors.append(res)
                 log(f"ERR: {res.get('repo')} -> {res.get('status')}: {res.get('error')}")
                 continue
 
             # Repo had no cookbooks; log to manifest for traceability
             if res.get("status") == "no_cookbooks":
-                write_jsonl(manifest_path, res)
+                manifest.append(res)
+                if checkpoint:
+                    checkpoint.mark(res["repo"])
                 log(f"NO-CKBK: {res.get('repo')} (commit {res.get('commit')})")
                 continue
 
             # Normal completion: write a single summary line for the repo
-            write_jsonl(manifest_path, res)
+            manifest.append(res)
 
             # Friendly console summary per repo
-            ok_count = sum(1 for c in res.get("cookbooks", []) if c.get("status") in ("ok", "skipped", "dry_run"))
+            ok_count = sum(1 for c in res.get("cookbooks", []) if c.get("status") in ("ok", "skipped", "skipped_idempotent", "dry_run"))
             err_count = sum(1 for c in res.get("cookbooks", []) if c.get("status") == "extract_error")
+            # Repos with extraction errors stay eligible for retry on resume
+            if checkpoint and not err_count:
+                checkpoint.mark(res["repo"])
             log(f"DONE: {res.get('repo')} cookbooks={ok_count}+{err_count} in {res.get('secs')}s")
-
+    except KeyboardInterrupt:
+        # Pending clones/extractions were cancelled by run_pipeline; still
+        # flush what finished so a rerun resumes from here.
+        interrupted = True
+        log("Interrupted: cancelled pending repos; flushing manifest and checkpoint")
+
+    if checkpoint:
+        checkpoint.close(completed=not interrupted)
+    manifest.close()
+    errors.close()
+    if interrupted:
+        sys.exit(130)
     log(f"All done in {round(time.time() - started, 2)}s. "
         f"Manifest: {manifest_path}  Errors: {errors_path}")
 